@@ -0,0 +1,121 @@
+import re
+import socket
+import struct
+import uuid
+
+
+class ContainerShell:
+    """
+    A shell running in a container which commands are written to one after another, so that running a command is a
+    write and read on a socket which is already open rather than the create, start and inspect requests to docker that
+    exec_run makes for every command.  The end of each command's output is found by having the shell print a marker
+    containing a random token, new for each command, to both stdout and stderr, followed on stdout by the command's exit
+    code.  If a command times out its output may still arrive later, so the shell is closed and cannot be used again.
+
+    Every command runs in the same shell, so changes such as the working directory or environment variables carry over
+    between commands.  Commands must not read from stdin, as that is where the following commands come from, and must
+    not exit the shell.
+    """
+    # Each frame docker sends when the exec has no TTY starts with a header of the stream type, three padding bytes
+    # and the size of the frame
+    FRAME_HEADER = struct.Struct(">BxxxL")
+    STDOUT = 1
+    STDERR = 2
+
+    def __init__(self, client, container_id):
+        """
+        Starts a shell in a container
+        :param client: - An instance of docker.DockerClient
+        :param container_id: - The ID of the container to start the shell in
+        """
+        exec_id = client.api.exec_create(container_id, ["sh"], stdin=True, stdout=True, stderr=True, tty=False)["Id"]
+        # docker returns a read only file-like wrapper around the socket, the socket itself is needed to write commands.
+        # The wrapper is kept as it holds a reference to the socket, which is only really closed once both are.
+        self._response = client.api.exec_start(exec_id, socket=True)
+        self._socket = getattr(self._response, "_sock", self._response)
+        self._closed = False
+        # Output which has been received but not yet returned, keyed by stream type
+        self._output = {self.STDOUT: bytearray(), self.STDERR: bytearray()}
+
+    def run(self, command, timeout=None):
+        """
+        Runs a command in the shell and waits for it to finish
+        :param command: - The command to run, written to the shell as is
+        :param timeout: - The maximum number of seconds to wait for output at a time, None to wait indefinitely
+        :return: - A tuple of the command's exit code, stdout and stderr
+        """
+        if self._closed:
+            raise ConnectionError("Shell has been closed")
+
+        marker = f"__SANDBOX_END_{uuid.uuid4().hex}__".encode("UTF-8")
+        stdout_end_pattern = re.compile(re.escape(marker) + rb"(\d+)\n")
+        stderr_end_marker = marker + b"\n"
+
+        try:
+            self._socket.settimeout(timeout)
+            self._socket.sendall(command.encode("UTF-8") + b"\nprintf '%s%d\\n' " + marker + b" $?; printf '%s\\n' "
+                                 + marker + b" >&2\n")
+
+            # The streams are sent separately, so wait for the marker on both to be sure all of the output has arrived
+            stdout_match = stdout_end_pattern.search(self._output[self.STDOUT])
+            stderr_end = self._output[self.STDERR].find(stderr_end_marker)
+            while stdout_match is None or stderr_end == -1:
+                stream_type = self._read_frame()
+                if stream_type == self.STDOUT:
+                    stdout_match = stdout_end_pattern.search(self._output[self.STDOUT])
+                elif stream_type == self.STDERR:
+                    stderr_end = self._output[self.STDERR].find(stderr_end_marker)
+        except OSError:
+            # Includes timeouts, the rest of this command's output would otherwise be mistaken for the next command's
+            self.close()
+            raise
+
+        exit_code = int(stdout_match.group(1))
+        stdout = bytes(self._output[self.STDOUT][:stdout_match.start()])
+        stderr = bytes(self._output[self.STDERR][:stderr_end])
+        # The match refers to the buffer, so it can only be removed once everything needed has been read from it
+        del self._output[self.STDOUT][:stdout_match.end()]
+        del self._output[self.STDERR][:stderr_end + len(stderr_end_marker)]
+        return exit_code, stdout, stderr
+
+    def close(self):
+        """
+        Closes the shell's stdin, the shell then exits
+        :return:
+        """
+        if self._closed:
+            return
+        self._closed = True
+        try:
+            # Shutting down the socket sends the EOF straight away, even if something else still holds a reference to it
+            self._socket.shutdown(socket.SHUT_WR)
+        except OSError:
+            pass  # The connection has already gone
+        self._response.close()
+        self._socket.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.close()
+
+    def _read_frame(self):
+        """
+        Reads a single frame of output from the socket into the buffer for its stream
+        :return: - The type of stream the frame was for
+        """
+        stream_type, size = self.FRAME_HEADER.unpack(self._read_exactly(self.FRAME_HEADER.size))
+        data = self._read_exactly(size)
+        if stream_type in self._output:
+            self._output[stream_type] += data
+        return stream_type
+
+    def _read_exactly(self, size):
+        data = bytearray()
+        while len(data) < size:
+            chunk = self._socket.recv(size - len(data))
+            if not chunk:
+                raise ConnectionError("Shell exited before the command finished")
+            data += chunk
+        return data
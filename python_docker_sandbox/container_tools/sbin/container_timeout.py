@@ -8,24 +8,45 @@ shutting down containers.  The script is copied into the container image on crea
 Commands:
     container_timeout.py timeout - Script will run until timeout has elapsed without being reset, will then exit
     container_timeout.py reset - Will reset the timeout period
+
+The pool manager resets the timeout with container_timeout_reset.sh rather than "container_timeout.py reset" so that a
+Python interpreter does not need to be started in every container each time the timeout is reset.  If the pool was
+given a timeout directory, a subdirectory of it belonging to that pool is bind mounted at /var/run/timeout_host and the
+pool manager instead writes a single deadline file there for all of its containers, the later of the two deadlines is
+used.
+
+The timeout must always be reset from outside the container.  Resetting it from within, e.g. with a docker HEALTHCHECK,
+would keep the container running after the sandbox application had gone away, which is what this script prevents.
 """
 import time
 import sys
 
+# Must match TIMEOUT_SECONDS in container_timeout_reset.sh
 TIMEOUT_SECONDS = 5
-CHECK_INTERVAL_SECONDS = 1
 TIMESTAMP_FILE = "/var/run/container_timeout.ts"
+HOST_DEADLINE_FILE = "/var/run/timeout_host/deadline"
+
+
+def read_deadline():
+    deadline = 0
+    for path in (TIMESTAMP_FILE, HOST_DEADLINE_FILE):
+        try:
+            with open(path, "r") as f:
+                deadline = max(deadline, int(f.read()))
+        except FileNotFoundError:
+            pass  # The host deadline file only exists if the pool was given a timeout directory
+    return deadline
 
 
 def do_timeout():
     reset_timeout()
     while True:
-        with open(TIMESTAMP_FILE, "r") as f:
-            file_timestamp = int(f.read())
-            current_time = time.time()
-            if current_time >= file_timestamp:
-                sys.exit()
-        time.sleep(1)
+        # Sleep until the deadline that was last written, if it has been reset in the meantime then the file will
+        # contain a later deadline and we go back to sleep until that one instead
+        remaining_seconds = read_deadline() - time.time()
+        if remaining_seconds <= 0:
+            sys.exit()
+        time.sleep(remaining_seconds)
 
 
 def reset_timeout():
@@ -46,4 +67,4 @@ def main():
         print("Command not understood, must be either \"timeout\" or \"reset\"")
 
 if __name__ == "__main__":
-    main()
\ No newline at end of file
+    main()
@@ -0,0 +1,10 @@
+#!/bin/sh
+# Resets the timeout used by container_timeout.py without starting a Python interpreter, the pool manager runs this in
+# every container at a regular interval.  The new deadline is written to a temporary file and moved into place so that
+# container_timeout.py never reads a partially written timestamp.
+
+# Must match TIMEOUT_SECONDS in container_timeout.py
+TIMEOUT_SECONDS=5
+TIMESTAMP_FILE=/var/run/container_timeout.ts
+
+echo $(($(date +%s) + TIMEOUT_SECONDS)) > "$TIMESTAMP_FILE.tmp" && mv "$TIMESTAMP_FILE.tmp" "$TIMESTAMP_FILE"
@@ -1,29 +1,82 @@
+import hashlib
 import io
 import logging
 import os
+import shlex
+import socket
 import tarfile
+import uuid
+from concurrent.futures import ThreadPoolExecutor, as_completed
 from contextlib import contextmanager
 
-from queue import Empty
-
 import time
+import threading
 import multiprocessing
-# TODO: Investigate this, seems to reqire fork when using a UNIX socket and spawn if using TCP.
 import docker.errors
+import docker.utils
+import requests.exceptions
+import urllib3.exceptions
+
+from python_docker_sandbox.shared_deque import SharedDeque
 
+# The pool manager is forked so that the pool and its shared memory are inherited rather than pickled.  The docker
+# client's open connections would be inherited too, so the pool manager creates its own client, see client_factory.
 mp_ctx = multiprocessing.get_context("fork")
 
 logger = logging.getLogger(__name__)
 
 
 class Pool:
+    __slots__ = ("client", "image_prefix", "image_name", "min_pool_size", "min_available", "required_packages",
+                 "base_image", "timeout_directory", "_deadline_directory", "recycle_containers", "wheel_directory",
+                 "network_enabled", "_available_workers", "_running_workers", "pool_manager_process",
+                 "pool_manager_stop_event", "_replacement_executor", "_replacement_executor_lock",
+                 "_pending_replacements", "_pool_changed", "_event_stream_connected", "_container_host_config",
+                 "_container_create_kwargs", "client_factory")
+
     CONTAINER_STOP_TIMEOUT = 0
+    # How often the respawner checks the pool size if it has not been woken by a change to the pool
+    POOL_MANAGER_INTERVAL_SECONDS = 30
+    # How soon the respawner checks the pool again if checking it failed, e.g. because docker could not be reached
+    POOL_MANAGER_RETRY_INTERVAL_SECONDS = 5
     # How long to wait between issuing reset commands to containers, should be less than the actual timeout interval
     # within the container to ensure some margin for error
     CONTAINER_RESETTER_INTERVAL_SECONDS = 3
-    DEAD_CONTAINER_CLEANUP_INTERVAL_SECONDS = 5
-
-    def __init__(self, client, image_suffix, min_pool_size, min_available, required_packages, base_image):
+    # How long to wait before reconnecting to docker's event stream if the connection is lost
+    EVENT_STREAM_RETRY_INTERVAL_SECONDS = 5
+    # How long to wait for an event before reconnecting, docker sends nothing while no containers die so this also
+    # catches connections which have silently gone away
+    EVENT_STREAM_READ_TIMEOUT_SECONDS = 60
+    # Must match TIMEOUT_SECONDS in container_timeout.py
+    CONTAINER_TIMEOUT_SECONDS = 5
+    CONTAINER_TIMEOUT_DIRECTORY = "/var/run/timeout_host"
+    CONTAINER_TIMEOUT_RESET_COMMAND = ["/container_tools/sbin/container_timeout_reset.sh"]
+    # The maximum number of containers that can be held in each of the available and running worker lists, must be a
+    # power of two
+    POOL_CAPACITY = 256
+    # The maximum number of containers to start at the same time when the pool needs topping up
+    MAX_PARALLEL_CONTAINER_STARTS = 16
+    # The maximum number of containers to kill at the same time when shutting down the pool
+    MAX_PARALLEL_CONTAINER_KILLS = 32
+    # How long get_container waits for a container to become available before starting one itself
+    AVAILABLE_CONTAINER_WAIT_SECONDS = 0.25
+    # When recycling containers, how many more available containers than the thresholds require are kept before the
+    # extras are shut down, so that a burst of containers being returned does not immediately cause them to be stopped
+    POOL_SURPLUS_ALLOWANCE = 2
+    # Run in a recycled container before returning it to the pool, removes everything in /tmp including hidden files
+    CONTAINER_CLEAN_COMMAND = ["sh", "-c", "rm -rf /tmp/* /tmp/.[!.]* /tmp/..?*"]
+    # Resource limits applied to every container, keeping them small lets more containers fit on the docker host
+    CONTAINER_MEMORY_LIMIT = "128m"
+    CONTAINER_PIDS_LIMIT = 64
+    CONTAINER_CPU_SHARES = 256
+    # Containers have a read only filesystem, these are the only writable locations.  /var/run holds the timeout file.
+    CONTAINER_TMPFS = {"/tmp": "size=64m", "/var/run": "size=1m"}
+    # How much of each build context file is read at a time when hashing it
+    IMAGE_HASH_CHUNK_SIZE = 1024 * 1024
+
+    def __init__(self, client, image_suffix, min_pool_size, min_available, required_packages, base_image,
+                 timeout_directory=None, recycle_containers=False, wheel_directory=None,
+                 network_enabled=False, client_factory=None):
         """
         Initialises a pool object
         :param client: - An instance of docker.DockerClient
@@ -33,27 +86,92 @@ class Pool:
         :param required_packages: - A list of packages to be installed, each entry should be in a format understood by
                                     pip (either a package name on its own or with version restrictions)
         :param base_image: - The name of a docker image to base the custom image on.  Must include python and pip.
+        :param timeout_directory: - Optional directory on the docker host which is bind mounted into every container.
+                                    When set the timeout resetter writes a single deadline file here rather than
+                                    executing the reset command in each container, so it must only be used when the
+                                    docker daemon shares this machine's filesystem.  Each pool uses its own
+                                    subdirectory, so pools sharing the directory, or containers left behind by a pool
+                                    which has crashed, are never kept alive by another pool.
+        :param recycle_containers: - If True containers are returned to the pool once they have been used, after /tmp
+                                     has been cleared, rather than being stopped and replaced.  This is much faster
+                                     but anything used by one piece of code other than /tmp, such as processes it has
+                                     left running or files written elsewhere, is visible to the next.  Only enable
+                                     this if the code run in the sandbox does not need to be isolated from each other.
+        :param wheel_directory: - Optional directory of wheels which is copied into the image, required packages are
+                                  then installed only from these wheels rather than from the package index.  It must
+                                  contain wheels for every required package and their dependencies, built for the base
+                                  image's platform (e.g. with pip wheel run in the base image).
+        :param network_enabled: - If True containers are connected to docker's default network, otherwise they have no
+                                  network access.  Leaving this disabled also makes containers quicker to start.
+        :param client_factory: - Optional callable returning a new docker.DockerClient.  If given the pool manager
+                                 process uses it to create its own client, rather than sharing the connections of the
+                                 client it inherited with this process.
         """
+        # The worker lists have a fixed size, so the pool must be able to hold enough containers to meet its thresholds
+        if max(min_pool_size, min_available) > self.POOL_CAPACITY:
+            raise ValueError(f"min_pool_size and min_available must be at most {self.POOL_CAPACITY}")
+
         self.client = client
-        self.image_name = f"sandbox-{image_suffix}"
+        self.client_factory = client_factory
+        self.image_prefix = f"sandbox-{image_suffix}"
+        # Set by build_image, as the tag is derived from the contents of the image
+        self.image_name = None
         self.min_pool_size = min_pool_size
         self.min_available = min_available
         self.required_packages = required_packages
         self.base_image = base_image
-
-        manager = mp_ctx.Manager()
-        self._available_workers = manager.list()
-        self._running_workers = manager.list()
+        self.timeout_directory = timeout_directory
+        # The subdirectory of the timeout directory which only this pool's containers can see
+        self._deadline_directory = None
+        if timeout_directory is not None:
+            self._deadline_directory = os.path.join(timeout_directory, uuid.uuid4().hex)
+            # Created now, as docker would otherwise create the bind mount source itself, owned by root
+            os.makedirs(self._deadline_directory, exist_ok=True)
+        self.recycle_containers = recycle_containers
+        self.wheel_directory = wheel_directory
+        self.network_enabled = network_enabled
+
+        self._available_workers = SharedDeque(mp_ctx, self.POOL_CAPACITY)
+        self._running_workers = SharedDeque(mp_ctx, self.POOL_CAPACITY)
         self.pool_manager_process = None
-        self.pool_manager_queue = None
-        self.container_timeout_resetter_process = None
-        self.container_timeout_resetter_queue = None
-        self.dead_container_cleanup_process = None
-        self.dead_container_cleanup_queue = None
+        self.pool_manager_stop_event = None
+        # Only created in the process that calls get_container, see _start_replacement_container
+        self._replacement_executor = None
+        # get_container may be called from several threads at once, this ensures they all share the one executor
+        self._replacement_executor_lock = threading.Lock()
+        # The number of replacement containers which have been requested but not yet added to the available workers, so
+        # that the respawner does not start containers to cover for them
+        self._pending_replacements = mp_ctx.Value("i", 0)
+        # Set whenever the pool may have dropped below its thresholds, wakes the respawner.  Changes which cannot leave
+        # the pool short, such as a container being added, do not set it
+        self._pool_changed = mp_ctx.Event()
+        # Set while the dead container listener is following docker's event stream, so dead containers are being
+        # removed from the pool as soon as they die
+        self._event_stream_connected = mp_ctx.Event()
+
+        # Every container is created with the same configuration, so build it once rather than for each container
+        binds = None
+        container_volumes = None
+        if timeout_directory is not None:
+            binds = {self._deadline_directory: {"bind": self.CONTAINER_TIMEOUT_DIRECTORY, "mode": "ro"}}
+            container_volumes = [self.CONTAINER_TIMEOUT_DIRECTORY]
+        # Without a network docker does not need to set up a network namespace with an interface for each container
+        self._container_host_config = client.api.create_host_config(auto_remove=True, binds=binds,
+                                                                    network_mode=None if network_enabled else "none",
+                                                                    read_only=True, tmpfs=self.CONTAINER_TMPFS,
+                                                                    mem_limit=self.CONTAINER_MEMORY_LIMIT,
+                                                                    pids_limit=self.CONTAINER_PIDS_LIMIT,
+                                                                    cpu_shares=self.CONTAINER_CPU_SHARES)
+        # Containers are always stopped immediately, so have docker send SIGKILL straight away rather than SIGTERM
+        self._container_create_kwargs = dict(detach=True, network_disabled=not network_enabled, stop_signal="SIGKILL",
+                                             volumes=container_volumes)
 
     def build_image(self):
         """
-        Builds a docker image based on the requirements specified at pool initialisation
+        Builds a docker image based on the requirements specified at pool initialisation.  The image is tagged with a
+        hash of its dockerfile and container tools, so if an image with that tag already exists it is reused and the
+        build is skipped entirely.  Note this means a moving base image tag (e.g. python:3-alpine) is not re-pulled
+        until something else about the image changes.
         :return:
         """
         # TODO: Validate that this installs the specific package version!
@@ -61,6 +179,8 @@ class Pool:
         # The container should run "tail -f /dev/null" as this will block and keep the container running, this also
         # doesn't require a TTY or STDIN to be open unlike other alternatives such as by running sh or cat
         container_tools_directory = os.path.join(os.path.dirname(os.path.abspath(__file__)), "container_tools")
+        # Directories added to the build context, keyed by their name within it
+        context_directories = {"container_tools": container_tools_directory}
 
         dockerfile_commands = [
             f"FROM {self.base_image}",
@@ -68,239 +188,563 @@ class Pool:
             "RUN chmod -R +x /container_tools/sbin/",
             "CMD [ \"/container_tools/sbin/container_timeout.py\", \"timeout\" ]"
         ]
-        for package in self.required_packages:
-            dockerfile_commands.append(f"RUN pip install --no-cache-dir {package}")
-
-        print(dockerfile_commands)
+        # Install every package with a single pip command so that pip resolves them together and one layer is created.
+        # Prefer wheels to avoid building packages from source, and skip pip's check for a newer version of itself.  If
+        # a wheel directory was given then the index is not used at all, so the install needs no network access.
+        if self.required_packages:
+            packages = " ".join(shlex.quote(package) for package in self.required_packages)
+            dockerfile_commands.append("ENV PIP_DISABLE_PIP_VERSION_CHECK=1")
+            if self.wheel_directory is not None:
+                context_directories["wheels"] = self.wheel_directory
+                dockerfile_commands.append("COPY wheels/ /wheels")
+                dockerfile_commands.append(f"RUN pip install --no-cache-dir --no-index --find-links=/wheels {packages}")
+            else:
+                dockerfile_commands.append(f"RUN pip install --no-cache-dir --prefer-binary {packages}")
+
+        logger.debug("Dockerfile commands: %s", dockerfile_commands)
 
         # Docker library wants a file, so convert our dockerfile array to a string then wrap in a file-like object
-        dockerfile_string = "\n".join(dockerfile_commands)
-
-        # Create in memory tar archive containing the build context
-        # TODO: Try and get this working with an in memory fileobj instead of a temp file
-        with tarfile.open(name="/tmp/build_context.tar", mode="w") as tar:
+        dockerfile_bytes = "\n".join(dockerfile_commands).encode("UTF-8")
+
+        self.image_name = f"{self.image_prefix}-{self._image_hash(dockerfile_bytes, context_directories)}"
+        try:
+            self.client.images.get(self.image_name)
+            logger.info(f"Image {self.image_name} already exists, skipping build")
+            return
+        except docker.errors.ImageNotFound:
+            pass
+
+        # Create in memory tar archive containing the build context.  It is left uncompressed as it is only a few
+        # kilobytes, so compressing it costs more CPU time than it saves in upload time.
+        build_context = io.BytesIO()
+        with tarfile.open(fileobj=build_context, mode="w") as tar:
             dockerfile_info = tarfile.TarInfo("dockerfile")
-            dockerfile_info.size = len(dockerfile_string)
-            tar.addfile(dockerfile_info, io.BytesIO(dockerfile_string.encode("UTF-8")))
-            tar.add(container_tools_directory, arcname="container_tools")
-
-        with open("/tmp/build_context.tar", "rb") as f:
-            logger.info("Building image")
-            self.client.images.build(fileobj=f, custom_context=True, tag=self.image_name)
+            dockerfile_info.size = len(dockerfile_bytes)
+            tar.addfile(dockerfile_info, io.BytesIO(dockerfile_bytes))
+            for arcname, directory in context_directories.items():
+                tar.add(directory, arcname=arcname,
+                        filter=lambda info: None if os.path.basename(info.name) == "__pycache__" else info)
+        build_context.seek(0)
+
+        logger.info("Building image")
+        self.client.images.build(fileobj=build_context, custom_context=True, tag=self.image_name)
         logger.info("Image created")
 
-    def start_container_timeout_resetter(self):
-        """
-        Starts _container_timeout_resetter_process running in the background
-        :return:
-        """
-        self.container_timeout_resetter_queue = mp_ctx.Queue()
-        self.container_timeout_resetter_process = mp_ctx.Process(target=self._container_timeout_resetter_process,
-                                                                 args=((self.container_timeout_resetter_queue),))
-        self.container_timeout_resetter_process.start()
-
-    def stop_container_timeout_resetter(self):
+    def _image_hash(self, dockerfile_bytes, context_directories):
         """
-        Issues a stop command to _container_timeout_resetter_process and waits for it to exit
-        :return:
+        Calculates a hash of everything that goes into the image's build context
+        :param dockerfile_bytes: - The encoded dockerfile
+        :param context_directories: - A dict of the directories which are added to the build context, keyed by their
+                                      name within it
+        :return: - The first 16 characters of the hex digest
         """
-        logger.info("Shutting down container timeout resetter")
-        self.container_timeout_resetter_queue.put("STOP")
-        self.container_timeout_resetter_queue.join()
+        image_hash = hashlib.sha256(dockerfile_bytes)
+        for arcname in sorted(context_directories):
+            context_directory = context_directories[arcname]
+            for directory, directory_names, file_names in os.walk(context_directory):
+                # Walk in a fixed order and skip bytecode caches, which are not part of the build context
+                directory_names[:] = sorted(name for name in directory_names if name != "__pycache__")
+                for file_name in sorted(file_names):
+                    file_path = os.path.join(directory, file_name)
+                    relative_path = os.path.join(arcname, os.path.relpath(file_path, context_directory))
+                    image_hash.update(b"\0" + relative_path.encode("UTF-8") + b"\0")
+                    # Read in chunks as the wheel directory can hold large files
+                    with open(file_path, "rb") as f:
+                        for chunk in iter(lambda: f.read(self.IMAGE_HASH_CHUNK_SIZE), b""):
+                            image_hash.update(chunk)
+        return image_hash.hexdigest()[:16]
 
     def start_pool_manager(self):
         """
-        Starts _container_respawner_process running in the background
+        Starts _pool_manager_process running in the background
         :return:
         """
-        self.pool_manager_queue = mp_ctx.Queue()
-        self.pool_manager_process = mp_ctx.Process(target=self._container_respawner_process,
-                                                   args=((self.pool_manager_queue),))
+        # A previous pool manager's executor has been shut down, a new one is created when it is first needed
+        self._replacement_executor = None
+        if self._deadline_directory is not None:
+            # Removed when a previous pool manager was stopped
+            os.makedirs(self._deadline_directory, exist_ok=True)
+        self.pool_manager_stop_event = mp_ctx.Event()
+        self.pool_manager_process = mp_ctx.Process(target=self._pool_manager_process,
+                                                   args=((self.pool_manager_stop_event),))
         self.pool_manager_process.start()
 
     def stop_pool_manager(self):
         """
-        Issues a stop command to _container_respawner_process and waits for it to exit
+        Signals _pool_manager_process to stop and waits for it to exit, all containers in the pool are shut down before
+        it exits
         :return:
         """
         logger.info("Shutting down pool manager")
-        self.pool_manager_queue.put("STOP")
+        # Wait for any replacement containers to finish starting so they are shut down along with the rest of the pool.
+        # The executor is kept once shut down, so that any later attempt to start a replacement fails rather than
+        # creating a new executor whose containers would never be shut down.
+        with self._replacement_executor_lock:
+            if self._replacement_executor is not None:
+                self._replacement_executor.shutdown(wait=True)
+        self.pool_manager_stop_event.set()
+        self._pool_changed.set()
         self.pool_manager_process.join()
+        # The listener is a daemon thread so exits with the process without clearing this itself
+        self._event_stream_connected.clear()
+        if self._deadline_directory is not None:
+            self._remove_deadline_directory()
 
-    def start_dead_container_cleanup_process(self):
-        """
-        Starts _dead_container_cleanup_process running in the background
-        :return:
-        """
-        self.dead_container_cleanup_queue = mp_ctx.Queue()
-        self.dead_container_cleanup_process = mp_ctx.Process(target=self._dead_container_cleanup_process,
-                                                   args=((self.dead_container_cleanup_queue),))
-        self.dead_container_cleanup_process.start()
-
-    def stop_dead_container_cleanup_process(self):
+    def _remove_deadline_directory(self):
         """
-        Issues a stop command to _dead_container_cleanup_process and waits for it to exit
+        Removes this pool's deadline directory once all of its containers have been shut down
         :return:
         """
-        logger.info("Shutting down dead container cleanup process")
-        self.dead_container_cleanup_queue.put("STOP")
-        self.dead_container_cleanup_process.join()
+        for file_name in ("deadline", "deadline.tmp"):
+            try:
+                os.remove(os.path.join(self._deadline_directory, file_name))
+            except FileNotFoundError:
+                pass
+        try:
+            os.rmdir(self._deadline_directory)
+        except OSError:
+            logger.warning(f"Could not remove timeout directory {self._deadline_directory}")
 
     @contextmanager
     def get_container(self):
         """
-        Removes a container from the list of available workers, adds it to the dict of running workers and then returns
-        it. This acts as a context manager so when the context runtime is exited the container will be stopped and
-        forgotten about so that a new, clean container can be spawned by the respawner process. Yields a container
-        object.
+        Removes a container from the list of available workers, adds it to the list of running workers and then returns
+        it. If no container is available it waits up to AVAILABLE_CONTAINER_WAIT_SECONDS for one, e.g. one which is
+        already being started, before starting a container itself. A replacement container is started in the background
+        straight away so that the pool is refilled while the container is in use. This acts as a context manager so
+        when the context runtime is exited the container will be stopped and forgotten about. Yields a container
+        object.  If the pool recycles containers no replacement is started, instead the container is cleaned and
+        returned to the available workers when the context runtime is exited.
         :return:
         """
-        container = None
-        container_found = False
-        while not container_found:
+        while True:
             try:
-                container_id = self._available_workers.pop(0)
-                container = self.client.containers.get(container_id)
-            except docker.errors.NotFound:
-                logger.warning("Container ID retrieved from the pool was not running, attempting to get another")
-                continue
+                container_id = self._available_workers.popleft(block=True,
+                                                               timeout=self.AVAILABLE_CONTAINER_WAIT_SECONDS)
             except IndexError:
-                logger.warning("No containers in pool when container requested, spawning container now")
-                container = self._start_container()
-            container_found = True
+                logger.warning("No containers became available when container requested, spawning container now")
+                container_id = self._start_container()
+                break
+            # While the listener is connected dead containers are removed from the pool as soon as docker reports them,
+            # so the container is only inspected to check it is still running if it is not
+            if self._event_stream_connected.is_set() or self._is_container_running(container_id):
+                break
+            logger.warning("Dead container found when container requested, trying another...")
+            self._pool_changed.set()
+        container = self.client.containers.prepare_model({"Id": container_id})
+
+        try:
+            self._running_workers.append(container.id)
+        except IndexError:
+            # Too many containers are in use for the pool to keep track of another, don't leave this one running
+            self._stop_container(container)
+            raise
+        # Everything after the container is added to the running workers is covered by the finally, so that it is always
+        # released even if starting its replacement fails
+        try:
+            if not self.recycle_containers:
+                self._start_replacement_container()
+            # Any replacement covers the container just taken, so the respawner only needs to know if the pool is now
+            # short, e.g. if the container had to be started here because none were available
+            if len(self._available_workers) + self._pending_replacements.value < self.min_available:
+                self._pool_changed.set()
+            yield container
+        finally:
+            try:
+                self._running_workers.remove(container.id)
+            except ValueError:
+                # The container died while in use and the dead container listener has already forgotten it, so there
+                # is nothing left to release
+                logger.warning(f"Container {container.id} died while in use")
+            else:
+                if self.recycle_containers:
+                    if not (self._clean_container(container.id) and self._recycle_container(container)):
+                        self._stop_container(container)
+                        # Recycled containers are not replaced when they are taken, so the pool is now short of this one
+                        self._pool_changed.set()
+                else:
+                    # We are now finished with the container so stop it
+                    self._stop_container(container)
+
+    def _is_container_running(self, container_id):
+        """
+        Inspects a container to check that it is still running
+        :param container_id: - The ID of the container to check
+        :return: - True if the container is running
+        """
+        try:
+            return self.client.api.inspect_container(container_id)["State"]["Running"]
+        except docker.errors.NotFound:
+            return False
+
+    def _stop_container(self, container):
+        """
+        Stops a container which has been taken out of the pool, a container which has already gone is treated as
+        stopped
+        :param container: - The container object to stop
+        :return:
+        """
+        try:
+            container.stop(timeout=self.CONTAINER_STOP_TIMEOUT)
+        except docker.errors.NotFound:
+            logger.warning(f"Container {container.id} had already stopped")
+
+    def _clean_container(self, container_id):
+        """
+        Runs CONTAINER_CLEAN_COMMAND in a container so that it can be reused.  The low level API is used as the exit
+        code of the command is needed to know whether it worked.
+        :param container_id: - The ID of the container to clean
+        :return: - True if the container was cleaned successfully
+        """
+        try:
+            exec_id = self.client.api.exec_create(container_id, cmd=self.CONTAINER_CLEAN_COMMAND)["Id"]
+            self.client.api.exec_start(exec_id)
+            return self.client.api.exec_inspect(exec_id)["ExitCode"] == 0
+        except docker.errors.APIError:
+            logger.warning(f"Failed to clean container {container_id}, it will be stopped rather than reused")
+            return False
+
+    def _recycle_container(self, container):
+        """
+        Returns a cleaned container to the available workers, if there is room for it.  It is put at the front so that
+        it is the next container handed out, as the most recently used container is the one most likely to still have
+        its files in the docker host's page cache.
+        :param container: - The container object to return
+        :return: - True if the container was returned, otherwise it must be stopped
+        """
+        try:
+            self._available_workers.appendleft(container.id)
+            return True
+        except IndexError:
+            return False
 
-        self._running_workers.append(container.id)
-        yield container
-        # We are now finished with the container so stop it
-        self._running_workers.remove(container.id)
-        container.stop(timeout=self.CONTAINER_STOP_TIMEOUT)
+    def _start_replacement_container(self):
+        """
+        Starts a new container on a background thread and adds it to the available workers once it is running.  The
+        executor is created on first use so that it is never inherited by the forked pool manager process.
+        :return:
+        """
+        with self._replacement_executor_lock:
+            if self._replacement_executor is None:
+                self._replacement_executor = ThreadPoolExecutor(max_workers=self.MAX_PARALLEL_CONTAINER_STARTS)
+            with self._pending_replacements.get_lock():
+                self._pending_replacements.value += 1
+            try:
+                self._replacement_executor.submit(self._add_replacement_container)
+            except RuntimeError:
+                # The pool manager has been stopped
+                with self._pending_replacements.get_lock():
+                    self._pending_replacements.value -= 1
+                raise
+
+    def _add_replacement_container(self):
+        """
+        Starts a new container and adds it to the available workers, run on the replacement executor
+        :return:
+        """
+        added = False
+        try:
+            added = self._add_available_container(self._start_container())
+        except docker.errors.APIError:
+            logger.exception("Failed to start replacement worker, the respawner will retry")
+        finally:
+            with self._pending_replacements.get_lock():
+                self._pending_replacements.value -= 1
+            # A successful start can only have grown the pool, so the respawner only needs waking if this failed
+            if not added:
+                self._pool_changed.set()
+
+    def _add_available_container(self, container_id):
+        """
+        Adds a newly started container to the available workers, killing it instead if there is no room for it so that
+        it is not left running without being tracked
+        :param container_id: - The ID of the container to add
+        :return: - True if the container was added
+        """
+        try:
+            self._available_workers.append(container_id)
+            return True
+        except IndexError:
+            logger.warning(f"Available workers are full, shutting down container {container_id}")
+            self._kill_container(container_id)
+            return False
 
     def _start_container(self):
         """
-        Starts a new container in the background
-        :return: - A container object
+        Starts a new container in the background.  The low level API is used so that docker is only asked to create
+        and start the container, containers.run would also inspect it afterwards.
+        :return: - The ID of the new container, which is all the pool stores
         """
-        container = self.client.containers.run(self.image_name, auto_remove=True, detach=True, network_disabled=True)
-        return container
+        container_id = self.client.api.create_container(self.image_name, host_config=self._container_host_config,
+                                                        **self._container_create_kwargs)["Id"]
+        self.client.api.start(container_id)
+        return container_id
 
     def _ensure_minimum_containers(self):
         """
         Checks the total number of containers based on the thresholds defined at pool initialisaion and if there are
-        too few containers it will spawn the appropriate number of new ones.
+        too few containers it will spawn the appropriate number of new ones.  The containers are started in parallel as
+        each start is a separate, slow, request to docker.
         :return:
         """
-        available_workers = len(self._available_workers)
+        # Take a single snapshot of the pool's size and work from it, rather than reading the shared lists repeatedly.
+        # Replacements which are still starting will shortly be available, so count them as if they already are.
+        available_workers = len(self._available_workers) + self._pending_replacements.value
         total_workers = available_workers + len(self._running_workers)
+        workers_to_start = max(0, self.min_available - available_workers, self.min_pool_size - total_workers)
 
-        workers_to_start = 0
-        available_difference = self.min_available - available_workers
-        if available_difference > 0:
-            workers_to_start = available_difference
-
-        pool_size_difference = self.min_pool_size - total_workers
-        if pool_size_difference > 0:
-            workers_to_start = max(workers_to_start, pool_size_difference)
-
+        started_workers = 0
         if workers_to_start > 0:
             logger.info(f"Starting {workers_to_start} workers")
+            with ThreadPoolExecutor(max_workers=min(workers_to_start, self.MAX_PARALLEL_CONTAINER_STARTS)) as executor:
+                futures = [executor.submit(self._start_container) for i in range(0, workers_to_start)]
+                for future in as_completed(futures):
+                    try:
+                        container_id = future.result()
+                    except docker.errors.APIError:
+                        logger.exception("Failed to start worker")
+                        continue
+                    if self._add_available_container(container_id):
+                        started_workers += 1
+        elif self.recycle_containers:
+            self._prune_surplus_containers(available_workers, total_workers)
+
+        logger.debug(f"{total_workers + started_workers} workers are currently running or starting")
+
+    def _prune_surplus_containers(self, available_workers, total_workers):
+        """
+        Shuts down available containers which are no longer needed.  Recycled containers are returned to the pool
+        rather than stopped, so containers started while others were in use would otherwise accumulate.  Containers
+        are only shut down once there are more than POOL_SURPLUS_ALLOWANCE beyond what the thresholds require.
+        :param available_workers: - The number of available workers
+        :param total_workers: - The total number of workers, available and running
+        :return:
+        """
+        surplus = min(available_workers - self.min_available, total_workers - self.min_pool_size)
+        if surplus <= self.POOL_SURPLUS_ALLOWANCE:
+            return
 
-        for i in range(0, workers_to_start):
-            container = self._start_container()
-            self._available_workers.append(container.id)
-
-        logger.debug(f"{len(self._available_workers) + len(self._running_workers)} workers are currently running")
+        logger.info(f"Shutting down {surplus} surplus workers")
+        for i in range(0, surplus):
+            try:
+                # Taken from the pool before being killed so that get_container cannot be given it in the meantime.
+                # Taken from the right, as recycled containers are put on the left, so the least recently used go first.
+                container_id = self._available_workers.pop()
+            except IndexError:
+                break
+            self._kill_container(container_id)
 
     def _shutdown_all_containers(self):
         """
-        Loops through all containers and shuts them down
+        Shuts down all containers, the containers are killed in parallel as each kill is a separate request to docker
         :return:
         """
         containers_to_stop = list(self._available_workers) + list(self._running_workers)
 
         logger.info(f"Shutting down {len(containers_to_stop)} containers")
 
-        for container_id in containers_to_stop:
-            container = self.client.containers.get(container_id)
-            logger.info(f"Shutting down container {container.id}")
-            container.stop(timeout=self.CONTAINER_STOP_TIMEOUT)
+        if containers_to_stop:
+            with ThreadPoolExecutor(max_workers=min(len(containers_to_stop),
+                                                    self.MAX_PARALLEL_CONTAINER_KILLS)) as executor:
+                list(executor.map(self._kill_container, containers_to_stop))
 
-    def _container_respawner_process(self, queue):
+    def _kill_container(self, container_id):
+        """
+        Kills a container, skipping it if it has already stopped.  Using the kill endpoint directly avoids looking up
+        the container first and skips the SIGTERM and wait that stopping a container involves.
+        :param container_id: - The ID of the container to kill
+        :return:
+        """
+        logger.info(f"Shutting down container {container_id}")
+        try:
+            self.client.api.kill(container_id, signal="SIGKILL")
+        except docker.errors.APIError:
+            # Docker reports a conflict rather than not found if the container has stopped but not yet been removed
+            logger.warning(f"Container {container_id} was not running when shutting down, skipping...")
+
+    def _pool_manager_process(self, stop_event):
         """
-        This process runs at a regular interval and checks how many containers are currently running, if there is an
+        This process runs the container respawner, container timeout resetter and dead container listener loops, each
+        on its own thread so that they share one interpreter and docker client.  Once told to stop it waits for the
+        respawner and resetter to exit and then shuts down all containers in the pool.  The listener spends its time
+        blocked reading docker's event stream so it runs as a daemon thread and simply exits with the process.  If the
+        pool has a client factory a new client is created first, the inherited client's connections may be in use by
+        the parent process at the time it was forked.
+        :param stop_event: - A multiprocessing event, this is used to stop the process by setting it.  The loops wait on
+                             it directly so they wake up as soon as it is set.
+        :return:
+        """
+        if self.client_factory is not None:
+            self.client = self.client_factory()
+
+        loops = [self._container_respawner_loop, self._container_timeout_resetter_loop]
+        threads = [threading.Thread(target=loop, args=(stop_event,), name=loop.__name__) for loop in loops]
+        for thread in threads:
+            thread.start()
+        threading.Thread(target=self._dead_container_listener_loop, args=(stop_event,),
+                         name="_dead_container_listener_loop", daemon=True).start()
+
+        stop_event.wait()
+        for thread in threads:
+            thread.join()
+        self._shutdown_all_containers()
+
+    def _container_respawner_loop(self, stop_event):
+        """
+        This loop checks how many containers are currently running whenever the pool changes, if there is an
         insufficient number (based on the thresholds supplied when the pool was initialised) it will spawn additional
-        containers.
-        :param queue: - A multiprocessing queue, this is used to stop the process by sending the string "STOP"
+        containers.  get_container replaces containers as they are taken, so this acts as a safety net for containers
+        which die or fail to start.  The pool is also checked every POOL_MANAGER_INTERVAL_SECONDS in case a change was
+        missed.  Errors are logged rather than ending the loop, which is retried after
+        POOL_MANAGER_RETRY_INTERVAL_SECONDS.
+        :param stop_event: - A multiprocessing event which is set when the loop should exit
         :return:
         """
-        while True:
-            self._ensure_minimum_containers()
+        while not stop_event.is_set():
+            wait_seconds = self.POOL_MANAGER_INTERVAL_SECONDS
             try:
-                msg = queue.get(block=True, timeout=0.5)  # TODO: Make timeout configurable
-                if msg == "STOP":
-                    self._shutdown_all_containers()
-                    break
-            except Empty:
-                pass  # We don't care if the queue is empty
-
-    def _container_timeout_resetter_process(self, queue):
-        """
-        This process regularly executes the container timeout reset command on all containers to ensure that they do
-        not timeout.  It will skip any containers who have an ID stored in the pool but do not exist within docker (e.g.
-        if the container has failed or was stopped by and external process)
-        :param queue: - A multiprocessing queue, this is used to stop the process by sending the string "STOP"
+                self._ensure_minimum_containers()
+            except Exception:
+                logger.exception("Failed to check the pool size, retrying")
+                wait_seconds = self.POOL_MANAGER_RETRY_INTERVAL_SECONDS
+            # Clear before checking the pool again so that a change made while checking wakes the loop straight away
+            self._pool_changed.wait(timeout=wait_seconds)
+            self._pool_changed.clear()
+
+    def _write_shared_deadline(self):
+        """
+        Writes the next timeout deadline to this pool's subdirectory of the timeout directory, this resets the timeout
+        of every container in the pool at once.  The file is written under a temporary name and then moved into place
+        so containers never read a partially written deadline.
         :return:
         """
-        while True:
-            next_reset_timestamp = int(time.time()) + self.CONTAINER_RESETTER_INTERVAL_SECONDS
-
-            container_ids_to_reset = self._available_workers + list(self._running_workers)
-            for container_id in container_ids_to_reset:
-                try:
-                    container = self.client.containers.get(container_id)
-                except docker.errors.NotFound:
-                    logger.warning("Attempted to reset timeout on a container from pool but container did not exist,"
-                                   " skipping...")
-                    continue
-                container.exec_run("/container_tools/sbin/container_timeout.py reset")
+        deadline_file = os.path.join(self._deadline_directory, "deadline")
+        with open(deadline_file + ".tmp", "w") as f:
+            f.write(str(int(time.time()) + self.CONTAINER_TIMEOUT_SECONDS))
+        os.replace(deadline_file + ".tmp", deadline_file)
 
+    def _reset_container_timeouts(self):
+        """
+        Executes the container timeout reset command on all containers.  It will skip any containers who have an ID
+        stored in the pool but do not exist within docker (e.g. if the container has failed or was stopped by and
+        external process).  The exec is started detached as its output is not needed, so each reset is two requests to
+        docker and nothing waits for the command to finish.
+        :return:
+        """
+        container_ids_to_reset = list(self._available_workers) + list(self._running_workers)
+        for container_id in container_ids_to_reset:
             try:
-                # Work out how long to wait until the time matches next_reset_timestamp
-                timeout_seconds = (next_reset_timestamp - int(time.time())) or 0
-                msg = queue.get(block=True, timeout=timeout_seconds)
-                if msg == "STOP":
-                    break
-            except Empty:
-                pass  # We don't care if the queue is empty
-
-    def _dead_container_cleanup_process(self, queue):
-        """
-        This process regularly checks that all of the container IDs stored in both the running workers and available
-        workers lists are actually still running within docker, if not it will remove the process from the appropriate
-        list.  This ensures that containers which have potentially crashed or otherwise failed are forgotten about so
-        that they can be respawned by the respawner process.
-        :param queue: - A multiprocessing queue, this is used to stop the process by sending the string "STOP"
+                exec_id = self.client.api.exec_create(container_id, cmd=self.CONTAINER_TIMEOUT_RESET_COMMAND,
+                                                      stdout=False, stderr=False)["Id"]
+                self.client.api.exec_start(exec_id, detach=True)
+            except docker.errors.APIError:
+                # Docker reports a conflict rather than not found if the container has stopped but not yet been removed
+                logger.warning("Attempted to reset timeout on a container from pool but container did not exist,"
+                               " skipping...")
+            except requests.exceptions.RequestException:
+                # Carry on with the rest of the containers rather than leaving them all to time out
+                logger.exception(f"Failed to reset timeout on container {container_id}, skipping...")
+
+    def _container_timeout_resetter_loop(self, stop_event):
+        """
+        This loop regularly resets the timeout of all containers to ensure that they do not timeout.  If the pool has
+        a timeout directory then a single deadline file shared by all containers is written, otherwise the reset
+        command is executed in each container.  Errors are logged rather than ending the loop, as every container
+        would time out if it stopped.
+        :param stop_event: - A multiprocessing event which is set when the loop should exit
         :return:
         """
-        while True:
-            all_container_ids = self._available_workers + list(self._running_workers)
-            for container_id in all_container_ids:
-                container_dead = False
-                try:
-                    self.client.containers.get(container_id)
-                except docker.errors.NotFound:
-                    logger.warning("Dead container found, forgetting...")
-                    container_dead = True
-
-                if container_dead:
-                    try:
-                        self._available_workers.remove(container_id)
-                        self._running_workers.remove(container_id)
-                    except (ValueError, KeyError):
-                        pass
+        while not stop_event.is_set():
+            reset_started = time.monotonic()
+
+            try:
+                if self.timeout_directory is not None:
+                    self._write_shared_deadline()
+                else:
+                    self._reset_container_timeouts()
+            except Exception:
+                logger.exception("Failed to reset container timeouts, retrying")
+
+            # Wait for the rest of the interval, less however long the reset took
+            elapsed_seconds = time.monotonic() - reset_started
+            stop_event.wait(timeout=max(0.0, self.CONTAINER_RESETTER_INTERVAL_SECONDS - elapsed_seconds))
+
+    def _forget_container(self, container_id):
+        """
+        Removes a container from both the available and running workers lists, if present, so that it can be respawned
+        :param container_id: - The ID of the container to forget
+        :return: - True if the container was in either list
+        """
+        forgotten = False
+        for workers in (self._available_workers, self._running_workers):
+            try:
+                workers.remove(container_id)
+                forgotten = True
+            except ValueError:
+                pass
+        return forgotten
 
+    def _forget_dead_containers(self):
+        """
+        Checks that all of the container IDs stored in both the running workers and available workers lists are
+        actually still running within docker, if not they are forgotten.  The running containers are retrieved from
+        docker with a single API call rather than checking each container individually.
+        :return:
+        """
+        all_container_ids = list(self._available_workers) + list(self._running_workers)
+        live_container_ids = {container["Id"] for container in
+                              self.client.api.containers(quiet=True, filters={"ancestor": self.image_name})}
+        for container_id in all_container_ids:
+            if container_id not in live_container_ids and self._forget_container(container_id):
+                logger.warning("Dead container found, forgetting...")
+                self._pool_changed.set()
+
+    def _dead_container_listener_loop(self, stop_event):
+        """
+        This loop follows docker's event stream and forgets containers from the pool as soon as they die.  This ensures
+        that containers which have potentially crashed or otherwise failed are forgotten about so that they can be
+        respawned by the respawner loop, without having to poll docker for the state of every container.  Each time
+        the stream is connected the pool is checked once with _forget_dead_containers, so containers which died while
+        it was disconnected are not missed.  Any error reconnects to the stream, so the loop only exits once stopped.
+        :param stop_event: - A multiprocessing event which is set when the loop should exit
+        :return:
+        """
+        event_filters = {"type": "container", "event": ["die", "destroy"], "image": self.image_name}
+        while not stop_event.is_set():
+            response = None
+            timed_out = False
             try:
-                msg = queue.get(block=True, timeout=self.DEAD_CONTAINER_CLEANUP_INTERVAL_SECONDS)
-                if msg == "STOP":
-                    break
-            except Empty:
-                pass  # We don't care if the queue is empty
+                response = self._open_event_stream(event_filters)
+                self._forget_dead_containers()
+                self._event_stream_connected.set()
+                for event in self.client.api._stream_helper(response, decode=True):
+                    container_id = event.get("Actor", {}).get("ID")
+                    # Containers stopped by get_container have already left the pool, so are not reported
+                    if container_id is not None and self._forget_container(container_id):
+                        logger.warning("Dead container found, forgetting...")
+                        self._pool_changed.set()
+            except (urllib3.exceptions.ReadTimeoutError, requests.exceptions.ReadTimeout, socket.timeout):
+                timed_out = True
+                logger.debug("No events received from docker, reconnecting to the event stream")
+            except Exception:
+                logger.exception("Lost connection to the docker event stream, reconnecting")
+            finally:
+                self._event_stream_connected.clear()
+                if response is not None:
+                    response.close()
+            # A quiet stream is normal, so only wait before reconnecting if something went wrong
+            if not timed_out:
+                stop_event.wait(timeout=self.EVENT_STREAM_RETRY_INTERVAL_SECONDS)
+
+    def _open_event_stream(self, event_filters):
+        """
+        Connects to docker's event stream.  This does the same as client.events, which cannot be given a timeout, but
+        with a read timeout so that a connection which has silently gone away is noticed.
+        :param event_filters: - The filters to apply to the events
+        :return: - The streaming response, its events are read with the API client's _stream_helper
+        """
+        api = self.client.api
+        response = api._get(api._url("/events"), params={"filters": docker.utils.convert_filters(event_filters)},
+                            stream=True, timeout=self.EVENT_STREAM_READ_TIMEOUT_SECONDS)
+        api._raise_for_status(response)
+        return response
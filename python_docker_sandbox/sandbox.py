@@ -1,5 +1,6 @@
 import io
 import logging
+import os
 import docker
 
 from python_docker_sandbox.pool import Pool
@@ -13,20 +14,31 @@ class Sandbox:
         self.client_key = client_key
         self.client_verify = client_verify
         self.pool = None
+        self.client = self._create_client()
 
-        url_type = base_url.split(":")[0].lower()
+    def _create_client(self):
+        """
+        Creates a docker client for the sandbox's base_url, also used by the pool to create a separate client for its
+        background process
+        :return: - An instance of docker.DockerClient
+        """
+        url_type = self.base_url.split(":")[0].lower()
         if url_type == "unix":
-            self.client = docker.DockerClient(base_url=base_url)
+            return docker.DockerClient(base_url=self.base_url)
         elif url_type == "tcp":
-            tls_config = docker.tls.TLSConfig(client_cert=(client_cert, client_key), verify=client_verify)
-            self.client = docker.DockerClient(base_url=base_url, tls=tls_config)
+            tls_config = docker.tls.TLSConfig(client_cert=(self.client_cert, self.client_key),
+                                              verify=self.client_verify)
+            return docker.DockerClient(base_url=self.base_url, tls=tls_config)
         else:
             raise ValueError("Invalid base_url")
 
     def init_pool(self, image_suffix, min_pool_size=5, min_available=2, required_packages=[],
-                  base_image="python:3-alpine"):
+                  base_image="python:3-alpine", timeout_directory=None, recycle_containers=False, wheel_directory=None,
+                  network_enabled=False):
         """
-        Initialise a pool of worker containers for the sandbox to execute code in
+        Initialise a pool of worker containers for the sandbox to execute code in. Returns once the pool manager has
+        been started, containers can then be taken from the pool with self.pool.get_container() which waits for one to
+        become available rather than needing the pool to be filled first
         :param image_suffix: A name to prefix to the image created by this process. If running multiple sandboxes, this
                              must be different between them all to avoid conflicts
         :param min_pool_size: The minimum number of unused containers
@@ -35,32 +47,33 @@ class Sandbox:
         :param required_packages: List of required Python packages that must be installed in the worker containers.
                                   These should be written using pip's requirements.txt syntax.
         :param base_image: The base docker image to build from
+        :param timeout_directory: Optional directory used to reset the timeout of every container with a single file
+                                  write rather than running a command in each container. Only use this if the docker
+                                  daemon runs on this machine, as the directory is bind mounted from the docker host.
+                                  Each pool uses its own subdirectory of it
+        :param recycle_containers: If True containers are cleaned and reused rather than replaced after each use. This
+                                   is much faster but only /tmp is cleared, so code run in the sandbox is not isolated
+                                   from code previously run in the same container
+        :param wheel_directory: Optional directory of wheels to install the required packages from instead of the
+                                package index. It must hold wheels for every required package and their dependencies,
+                                built for the base image's platform
+        :param network_enabled: If True the worker containers are given network access, by default they have none
         :return:
         """
 
-        self.pool = Pool(self.client, image_suffix, min_pool_size, min_available, required_packages, base_image)
+        if timeout_directory is not None:
+            # Docker requires an absolute path for bind mounts
+            timeout_directory = os.path.abspath(timeout_directory)
+            os.makedirs(timeout_directory, exist_ok=True)
+        self.pool = Pool(self.client, image_suffix, min_pool_size, min_available, required_packages, base_image,
+                         timeout_directory, recycle_containers, wheel_directory, network_enabled, self._create_client)
         self.pool.build_image()
         self.pool.start_pool_manager()
 
-        import time
-        time.sleep(5)
-        self.pool.start_container_timeout_resetter()
-        self.pool.start_dead_container_cleanup_process()
-        while True:
-            print("RUNNING COMMAND")
-            with self.pool.get_container() as container:
-                print(container.exec_run("uname -a"))
-            time.sleep(1)
-
-        # import time
-        # time.sleep(5)
-        # print(self.pool._available_workers)
-        # self.pool.stop_pool_manager()
-
-        # self.pool._ensure_minimum_containers()
-        #
-        # while True:
-        #     with self.pool.get_container() as container:
-        #         print(container.exec_run("uname -a"))
-        #
-        #     self.pool._ensure_minimum_containers()
+    def shutdown_pool(self):
+        """
+        Stops the pool's background process and shuts down all of its containers
+        :return:
+        """
+        self.pool.stop_pool_manager()
+        self.pool = None
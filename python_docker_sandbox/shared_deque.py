@@ -0,0 +1,142 @@
+import time
+
+
+class SharedDeque:
+    """
+    A fixed capacity double ended queue of short strings (container IDs) stored in shared memory, so that it can be used
+    by the pool's background processes without the round trip to a manager process which a multiprocessing.Manager
+    list requires for every operation.  Items are stored in a ring buffer of fixed size slots, described by the slot
+    holding the leftmost item and the number of items, so items can be added and removed at either end.  A single lock
+    guards the buffer, CPython has no portable atomic compare-and-swap so this is the cheapest safe option, and is still
+    only a futex rather than a pickle and socket round trip.
+    """
+    SLOT_SIZE = 64
+
+    def __init__(self, ctx, capacity=256):
+        """
+        Initialises a shared deque, this must be done before any processes that will use it are started
+        :param ctx: - The multiprocessing context used to allocate the shared memory and lock
+        :param capacity: - The maximum number of items that can be held, must be a power of two
+        """
+        if capacity <= 0 or capacity & (capacity - 1):
+            raise ValueError("capacity must be a power of two")
+
+        self._capacity = capacity
+        self._mask = capacity - 1
+        self._slots = ctx.RawArray("c", capacity * self.SLOT_SIZE)
+        # Always a slot index, i.e. less than capacity, so that it never needs to go below zero when appending left
+        self._head = ctx.RawValue("Q", 0)
+        # A single value so that len() is one read which does not need the lock
+        self._size = ctx.RawValue("Q", 0)
+        self._lock = ctx.Lock()
+        self._not_empty = ctx.Condition(self._lock)
+
+    def append(self, item):
+        """
+        Adds an item to the right hand side of the deque
+        :param item: - The string to add, must encode to at most SLOT_SIZE bytes
+        :return:
+        """
+        encoded = self._encode(item)
+        with self._lock:
+            if self._size.value == self._capacity:
+                raise IndexError("append to a full SharedDeque")
+            self._write_slot(self._head.value + self._size.value, encoded)
+            self._size.value += 1
+            self._not_empty.notify()
+
+    def appendleft(self, item):
+        """
+        Adds an item to the left hand side of the deque, so that it is the next item returned by popleft
+        :param item: - The string to add, must encode to at most SLOT_SIZE bytes
+        :return:
+        """
+        encoded = self._encode(item)
+        with self._lock:
+            if self._size.value == self._capacity:
+                raise IndexError("append to a full SharedDeque")
+            self._head.value = (self._head.value - 1) & self._mask
+            self._write_slot(self._head.value, encoded)
+            self._size.value += 1
+            self._not_empty.notify()
+
+    def popleft(self, block=False, timeout=None):
+        """
+        Removes and returns the item on the left hand side of the deque, raises IndexError if the deque is empty
+        :param block: - If True and the deque is empty, wait for an item to be appended
+        :param timeout: - The maximum number of seconds to wait when blocking, None to wait indefinitely
+        :return: - The removed item
+        """
+        deadline = None if timeout is None else time.monotonic() + timeout
+        with self._lock:
+            while self._size.value == 0:
+                remaining_seconds = None if deadline is None else deadline - time.monotonic()
+                if not block or (remaining_seconds is not None and remaining_seconds <= 0):
+                    raise IndexError("pop from an empty SharedDeque")
+                self._not_empty.wait(remaining_seconds)
+            item = self._read_slot(self._head.value)
+            self._head.value = (self._head.value + 1) & self._mask
+            self._size.value -= 1
+        return item
+
+    def pop(self):
+        """
+        Removes and returns the item on the right hand side of the deque, raises IndexError if the deque is empty
+        :return: - The removed item
+        """
+        with self._lock:
+            if self._size.value == 0:
+                raise IndexError("pop from an empty SharedDeque")
+            self._size.value -= 1
+            return self._read_slot(self._head.value + self._size.value)
+
+    def remove(self, item):
+        """
+        Removes the first occurrence of an item, raises ValueError if it is not present
+        :param item: - The item to remove
+        :return:
+        """
+        with self._lock:
+            head = self._head.value
+            tail = head + self._size.value
+            for position in range(head, tail):
+                if self._read_slot(position) == item:
+                    break
+            else:
+                raise ValueError(f"{item} is not in SharedDeque")
+
+            # Shift everything after the removed item one slot to the left to close the gap
+            for position in range(position, tail - 1):
+                self._write_slot(position, self._slots[self._slot_range(position + 1)])
+            self._size.value -= 1
+
+    def __len__(self):
+        # An aligned 8 byte read, so this always sees a value the size actually had even without the lock.  As with any
+        # shared container the result may be out of date as soon as it is returned.
+        return self._size.value
+
+    def __iter__(self):
+        """
+        Iterates over a snapshot of the items, taken when iteration begins
+        :return:
+        """
+        with self._lock:
+            head = self._head.value
+            items = [self._read_slot(position) for position in range(head, head + self._size.value)]
+        return iter(items)
+
+    def _encode(self, item):
+        encoded = item.encode("UTF-8")
+        if len(encoded) > self.SLOT_SIZE:
+            raise ValueError(f"Items must be at most {self.SLOT_SIZE} bytes")
+        return encoded
+
+    def _slot_range(self, position):
+        start = (position & self._mask) * self.SLOT_SIZE
+        return slice(start, start + self.SLOT_SIZE)
+
+    def _read_slot(self, position):
+        return self._slots[self._slot_range(position)].rstrip(b"\0").decode("UTF-8")
+
+    def _write_slot(self, position, encoded):
+        self._slots[self._slot_range(position)] = encoded.ljust(self.SLOT_SIZE, b"\0")
@@ -1,3 +1,4 @@
+from python_docker_sandbox.container_shell import ContainerShell
 from python_docker_sandbox.sandbox import Sandbox
 import logging
 
@@ -11,6 +12,16 @@ def main():
     #                   client_verify="/Users/camerong/.docker/machine/certs/ca.pem")
     sandbox = Sandbox()
     sandbox.init_pool("testing", required_packages=["tabulate", "flask"], min_pool_size=10)
+    try:
+        while True:
+            print("RUNNING COMMAND")
+            with sandbox.pool.get_container() as container, ContainerShell(sandbox.client, container.id) as shell:
+                print(shell.run("uname -a"))
+                print(shell.run("python --version"))
+    except KeyboardInterrupt:
+        pass
+    finally:
+        sandbox.shutdown_pool()
 
 
 if __name__ == "__main__":